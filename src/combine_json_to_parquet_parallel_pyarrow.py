@@ -1,35 +1,91 @@
 #!/usr/bin/env python3
+"""
+Combine JSON to Parquet
 
+Parses every .json file below a directory in parallel and streams the
+documents into Parquet, preserving each one as a nested 'data' struct.
+
+Configuration (environment variables):
+    PARQUET_COMPRESSION  codec for the output (default: zstd)
+    PARQUET_WRITERS      number of Parquet files encoded in parallel (default: 1).
+                         With the default, a single file is written and encoding
+                         and compression run on one background thread; set it to
+                         e.g. the number of cores to write that many
+                         part-NNNN.parquet shards into an output directory instead.
+    PARQUET_SCHEMA       Parquet file whose schema is used as the starting schema
+                         instead of the one inferred from the first batch
+
+The schema is widened whenever a later batch has new keys or values in fields
+that were null so far, so the output holds every field of every document.
+"""
+
+import mmap
 import os
-import json
 import sys
-from multiprocessing import Pool, cpu_count
-from functools import partial  # To pass fixed arguments to the worker function
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count, get_context
 
+import orjson
 import pyarrow as pa
 import pyarrow.parquet as pq
 
+# Parquet codec: 'zstd' (default), 'snappy', 'gzip', 'brotli', 'lz4' or 'none'
+PARQUET_COMPRESSION = (os.getenv("PARQUET_COMPRESSION") or "zstd").lower()
+# Number of Parquet files written concurrently; >1 writes part-NNNN.parquet
+# shards into a directory named after the output
+PARQUET_WRITERS = int(os.getenv("PARQUET_WRITERS") or 1)
+# Optional Parquet file (e.g. a previous output) whose schema is used as the
+# starting schema instead of inferring one from the first batch
+PARQUET_SCHEMA = os.getenv("PARQUET_SCHEMA")
+
+
+# Length of the root directory prefix (including the trailing separator) that
+# is stripped from each path; set once per worker process by init_worker
+_ROOT_LEN = 0
+# Files at least this large are memory-mapped instead of read into memory;
+# below it the extra mmap/munmap syscalls cost more than the copy saves
+MMAP_MIN_SIZE = 1 << 20
+
+
+# --- Worker initializer ---
+def init_worker(root_dir):
+    """
+    Stores the root directory prefix length in the worker process so it isn't
+    pickled into every task and relative paths can be computed by slicing.
+    """
+    global _ROOT_LEN
+    _ROOT_LEN = len(os.path.join(root_dir, ""))
+
 
 # --- Worker function for a single JSON file ---
-def process_single_json_file(file_path, root_dir):
+def process_single_json_file(file_path):
     """
-    Reads, parses, and formats data from a single JSON file.
-    Includes metadata and the original unflattened JSON content.
-    Returns a dictionary suitable for an Arrow Table row.
+    Reads and parses data from a single JSON file.
+    Returns an (original_file_path, original_filename, data) tuple, where data
+    is the original unflattened JSON content; the tuple is cheaper to send back
+    to the main process than a per-record wrapper dict.
+    Expects paths produced by iter_json_files under the root given to init_worker.
     """
     try:
-        with open(file_path, "r", encoding="utf-8") as infile:
-            json_data = json.load(infile)
-
-        # Create a wrapper dictionary including metadata and the actual data
-        record_to_write = {
-            "original_file_path": os.path.relpath(file_path, root_dir),
-            "original_filename": os.path.basename(file_path),
-            "data": json_data,  # The original, unflattened content
-        }
-        return record_to_write
-
-    except json.JSONDecodeError as e:
+        # Work on the raw file descriptor: for small files, building a file
+        # object costs more than the read itself. Large files are mapped
+        # straight from the page cache and parsed in place
+        fd = os.open(file_path, os.O_RDONLY)
+        try:
+            size = os.fstat(fd).st_size
+            if size >= MMAP_MIN_SIZE:
+                with mmap.mmap(
+                    fd, 0, access=mmap.ACCESS_READ
+                ) as mapped, memoryview(mapped) as view:
+                    json_data = orjson.loads(view)
+            else:
+                json_data = orjson.loads(os.read(fd, size))
+        finally:
+            os.close(fd)
+
+        return file_path[_ROOT_LEN:], os.path.basename(file_path), json_data
+
+    except orjson.JSONDecodeError as e:
         print(f"Error decoding JSON from {file_path}: {e}", file=sys.stderr)
         return None  # Indicate failure for this file
     except FileNotFoundError:
@@ -40,16 +96,177 @@ def process_single_json_file(file_path, root_dir):
         return None
 
 
+# --- Directory scanner ---
+def iter_json_files(root_dir):
+    """
+    Yields the paths of all .json files below root_dir.
+    Uses os.scandir, whose DirEntry objects carry the file type from the
+    directory listing, so no extra stat call is made per entry.
+    """
+    stack = [root_dir]
+    while stack:
+        dir_path = stack.pop()
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.endswith(".json"):
+                    yield entry.path
+
+
+# --- Incremental Parquet writers ---
+def segment_path(path, segment):
+    """
+    Temporary path of one segment of a Parquet output. Each segment holds the
+    batches written with one schema; they are merged and renamed to `path`
+    once the whole run has succeeded.
+    """
+    return f"{path}.{segment}.tmp"
+
+
+def open_parquet_writer(path, schema):
+    """Opens a ParquetWriter with the codec and encoding options used for all output."""
+    # zstd level 1 compresses about as fast as snappy with much smaller files
+    return pq.ParquetWriter(
+        path,
+        schema,
+        compression=PARQUET_COMPRESSION,
+        compression_level=1 if PARQUET_COMPRESSION == "zstd" else None,
+        use_dictionary=True,
+        data_page_size=1 << 20,
+        write_statistics=False,
+        use_byte_stream_split=False,
+    )
+
+
+def widen_type(current, inferred):
+    """
+    Returns a type that can hold values of both `current` and `inferred`:
+    struct keys are merged, null-typed fields take the other side's type and
+    integers are promoted to floats. Raises pa.ArrowTypeError for types that
+    can't be combined, such as a field holding numbers in one batch and
+    strings in another.
+    """
+    return pa.unify_schemas(
+        [pa.schema([("data", current)]), pa.schema([("data", inferred)])],
+        promote_options="permissive",
+    ).field("data").type
+
+
+def close_writers(writers, pending):
+    """Waits for in-flight batches and closes all open writers."""
+    for shard, writer in enumerate(writers):
+        if writer is None:
+            continue
+        if pending[shard] is not None:
+            pending[shard].result()
+            pending[shard] = None
+        writer.close()
+        writers[shard] = None
+
+
+def write_records_batch(
+    write_pool, writers, pending, segments, output_paths, batch_number, records, schema=None
+):
+    """
+    Converts a list of record tuples into a RecordBatch and hands it to
+    one of the output writers (chosen round-robin) on the write thread pool.
+    Arrow releases the GIL while encoding and compressing, so the writers run
+    in parallel with each other and with the main thread.
+    Returns the schema the batch was written with, which the caller passes
+    back in for the next batch.
+    Unless an explicit schema is given, the first batch's inferred schema is
+    used for the output. When a later batch has keys the schema lacks, or
+    values in fields that were always null so far, the schema is widened
+    (see widen_type): the open writers are closed and new segments are
+    started, which merge_segments later combines into one file per output.
+    Writers are created lazily and each has at most one batch in flight.
+    """
+    file_paths, filenames, documents = zip(*records)
+    # Only the JSON documents need a nested type; the metadata columns are
+    # plain strings built directly from the path lists.
+    # pa.array infers the nested StructType in Arrow's C++ layer, which is
+    # much faster than the row-by-row conversion done by Table.from_pylist.
+    # Every batch is inferred even once the schema is known: converting with
+    # type= silently drops keys outside the schema and truncates floats in
+    # integer fields, and checking the documents for those in Python costs
+    # about as much as the inference it would save
+    data = pa.array(documents)
+    if schema is None:
+        schema = pa.schema(
+            [
+                pa.field("original_file_path", pa.string()),
+                pa.field("original_filename", pa.string()),
+                pa.field("data", data.type),
+            ]
+        )
+        print("\nArrow Schema:")
+        print(schema)
+    elif data.type != schema.field("data").type:
+        data_type = widen_type(schema.field("data").type, data.type)
+        if data_type != schema.field("data").type:
+            # A Parquet file has a single schema, so batches with the wider
+            # type go to new segments
+            print(f"\nWidening the schema at batch {batch_number}.")
+            close_writers(writers, pending)
+            schema = schema.set(
+                schema.get_field_index("data"), pa.field("data", data_type)
+            )
+        # Fills in fields this batch doesn't have; never drops any
+        data = data.cast(data_type)
+    batch = pa.RecordBatch.from_arrays(
+        [
+            pa.array(file_paths, type=pa.string()),
+            pa.array(filenames, type=pa.string()),
+            data,
+        ],
+        schema=schema,
+    )
+
+    shard = batch_number % len(output_paths)
+    if writers[shard] is None:
+        segments[shard].append(
+            segment_path(output_paths[shard], len(segments[shard]))
+        )
+        writers[shard] = open_parquet_writer(segments[shard][-1], schema)
+    elif pending[shard] is not None:
+        pending[shard].result()
+    pending[shard] = write_pool.submit(writers[shard].write_batch, batch)
+    return schema
+
+
+def merge_segments(paths, output_path, schema):
+    """
+    Rewrites the segments of one output into a single file with the final
+    (widest) schema, casting the row groups written with narrower schemas.
+    """
+    with open_parquet_writer(output_path, schema) as writer:
+        for path in paths:
+            parquet_file = pq.ParquetFile(path)
+            for i in range(parquet_file.num_row_groups):
+                writer.write_table(parquet_file.read_row_group(i).cast(schema))
+
+
 # --- Main parallelization function ---
 def combine_json_to_parquet_parallel_pyarrow(
-    root_dir, output_parquet_name="combined_data_pyarrow.parquet", num_processes=None
+    root_dir,
+    output_parquet_name="combined_data_pyarrow.parquet",
+    num_processes=None,
+    batch_size=10_000,
+    num_writers=PARQUET_WRITERS,
+    schema=None,
 ):
     """
     Recursively gathers all .json files in parallel, parses their content,
     and combines them into a single Parquet file using PyArrow directly.
     The original nested JSON structure is preserved within a a 'data' column (as a struct type).
+    Records are streamed to the file in row groups of up to `batch_size` rows.
+    With `num_writers` > 1 the output is a directory of that many Parquet shards
+    which are encoded and compressed in parallel.
+    `schema` (or the schema of the PARQUET_SCHEMA file) is used as the starting
+    schema instead of the one inferred from the first batch; either way it is
+    widened as later batches need.
     """
-    all_json_file_paths = []
     print(f"Scanning directory: {root_dir} for JSON files...")
 
     # Validate root_dir
@@ -60,83 +277,150 @@ def combine_json_to_parquet_parallel_pyarrow(
         )
         sys.exit(1)
 
-    # Collect all JSON file paths (this part is sequential but fast)
-    for dirpath, dirnames, filenames in os.walk(root_dir):
-        for filename in filenames:
-            if filename.endswith(".json"):
-                all_json_file_paths.append(os.path.join(dirpath, filename))
-
-    if not all_json_file_paths:
-        print(f"No JSON files found in '{root_dir}'.", file=sys.stderr)
-        sys.exit(0)
-
-    print(
-        f"\nFound {len(all_json_file_paths)} JSON files. Starting parallel processing..."
-    )
-
     # Determine number of processes
     if num_processes is None:
         num_processes = max(1, cpu_count() - 1)  # Use all but one core
     print(f"Using {num_processes} worker processes.")
 
-    all_records = []
-    # Use multiprocessing Pool to parallelize file processing
-    func_with_root_dir = partial(process_single_json_file, root_dir=root_dir)
+    if schema is None and PARQUET_SCHEMA:
+        schema = pq.read_schema(PARQUET_SCHEMA).remove_metadata()
+        print(f"Using schema from: {PARQUET_SCHEMA}")
+    print("Starting parallel processing...")
 
-    try:
-        with Pool(processes=num_processes) as pool:
-            results = pool.map(func_with_root_dir, all_json_file_paths)
+    if num_writers > 1:
+        # Shards from an earlier run would silently be mixed into the dataset
+        if os.path.isdir(output_parquet_name) and os.listdir(output_parquet_name):
+            print(
+                f"Error: Output directory '{output_parquet_name}' is not empty.",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+        os.makedirs(output_parquet_name, exist_ok=True)
+        output_paths = [
+            os.path.join(output_parquet_name, f"part-{i:04d}.parquet")
+            for i in range(num_writers)
+        ]
+    else:
+        output_paths = [output_parquet_name]
 
-            # Filter out None results (from failed file processing)
-            all_records = [record for record in results if record is not None]
+    files_processed = 0
+    records_written = 0
+    batches_written = 0
+    buffer = []
+    writers = [None] * len(output_paths)
+    pending = [None] * len(output_paths)
+    segments = [[] for _ in output_paths]
+    succeeded = False
+    # Hand paths to workers in chunks to amortize pickling/IPC per task. The
+    # number of files isn't known up front since the directory is scanned lazily
+    chunksize = 64
 
-    except Exception as e:
-        print(f"Error during parallel processing: {e}", file=sys.stderr)
-        sys.exit(1)
+    try:
+        # Use a multiprocessing Pool to parallelize file processing. Workers are
+        # spawned rather than forked: each starts from a clean interpreter instead
+        # of a copy of the parent (which runs writer threads), and fork is unsafe
+        # on macOS
+        with get_context("spawn").Pool(
+            processes=num_processes, initializer=init_worker, initargs=(root_dir,)
+        ) as pool, ThreadPoolExecutor(
+            max_workers=len(output_paths)
+        ) as write_pool:
+            # The directory scan is consumed by the pool as workers take tasks, and
+            # results stream back as workers finish so that only a few batches of
+            # records are held in memory while the Parquet output is being written
+            for record in pool.imap_unordered(
+                process_single_json_file, iter_json_files(root_dir), chunksize=chunksize
+            ):
+                files_processed += 1
+                # Skip None results (from failed file processing)
+                if record is None:
+                    continue
+                buffer.append(record)
+                if len(buffer) >= batch_size:
+                    schema = write_records_batch(
+                        write_pool,
+                        writers,
+                        pending,
+                        segments,
+                        output_paths,
+                        batches_written,
+                        buffer,
+                        schema,
+                    )
+                    records_written += len(buffer)
+                    batches_written += 1
+                    buffer = []
 
-    if not all_records:
-        print("No valid JSON documents were processed to combine.", file=sys.stderr)
-        sys.exit(0)
+            if buffer:
+                schema = write_records_batch(
+                    write_pool,
+                    writers,
+                    pending,
+                    segments,
+                    output_paths,
+                    batches_written,
+                    buffer,
+                    schema,
+                )
+                records_written += len(buffer)
+                batches_written += 1
+                buffer = []
 
-    print(f"\nSuccessfully processed {len(all_records)} valid JSON documents.")
+            # Surface any error raised on the write threads
+            close_writers(writers, pending)
 
-    # --- Key Change: Convert list of dictionaries to PyArrow Table ---
-    try:
-        # PyArrow's from_pylist can infer complex nested schemas from Python dicts/lists
-        arrow_table = pa.Table.from_pylist(all_records)
-    except pa.ArrowInvalid as e:
+        # Outputs written before the schema was last widened consist of several
+        # segments, or of one with a narrower schema; rewrite them so every
+        # output is one file with the final schema
+        for shard, paths in enumerate(segments):
+            if len(paths) > 1 or (
+                paths and not pq.read_schema(paths[0]).equals(schema)
+            ):
+                print(f"Rewriting {output_paths[shard]} with the final schema...")
+                merged_path = segment_path(output_paths[shard], len(paths))
+                paths.append(merged_path)
+                merge_segments(paths[:-1], merged_path, schema)
+        succeeded = True
+
+    except pa.ArrowException as e:
         print(
-            f"Error converting Python list to Arrow Table. This often indicates inconsistent schemas or complex nested types that PyArrow can't infer easily. Error: {e}",
+            f"Error converting records to Arrow. This often indicates a field whose type differs between documents (e.g. a number in some and a string in others). Error: {e}",
             file=sys.stderr,
         )
-        # For more complex cases, you might need to define the PyArrow schema explicitly
-        # and then use pa.array to create columns.
         sys.exit(1)
     except Exception as e:
-        print(
-            f"An unexpected error occurred during PyArrow Table creation: {e}",
-            file=sys.stderr,
-        )
+        print(f"Error during parallel processing: {e}", file=sys.stderr)
         sys.exit(1)
+    finally:
+        for writer in writers:
+            if writer is not None:
+                writer.close()
+        # Only move complete output into place; never leave a truncated file
+        # at the output path after a failure
+        for shard, paths in enumerate(segments):
+            if succeeded and paths:
+                os.replace(paths.pop(), output_paths[shard])
+            for path in paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    if not files_processed:
+        print(f"No JSON files found in '{root_dir}'.", file=sys.stderr)
+        sys.exit(0)
+
+    if not records_written:
+        print("No valid JSON documents were processed to combine.", file=sys.stderr)
+        sys.exit(0)
 
     print(
-        f"Arrow Table created with {arrow_table.num_rows} rows and {arrow_table.num_columns} columns."
+        f"\nSuccessfully processed {records_written} valid JSON documents out of {files_processed} JSON files."
     )
-    print("\nArrow Table Schema:")
-    print(arrow_table.schema)
-    # print("\nFirst few rows (limited for brevity):")
-    # print(arrow_table.slice(length=5).to_pydict()) # Print first 5 rows as Python dicts
-
-    # Save the Arrow Table to a Parquet file
-    try:
-        # 'compression' can be 'snappy', 'gzip', 'brotli', 'lz4', 'zstd'
-        pq.write_table(arrow_table, output_parquet_name, compression="snappy")
-        print(f"\nSuccessfully created Parquet file: {output_parquet_name}")
-    except Exception as e:
+    if num_writers > 1:
         print(
-            f"Error writing Parquet file '{output_parquet_name}': {e}", file=sys.stderr
+            f"\nSuccessfully created {sum(map(bool, segments))} Parquet files in: {output_parquet_name}"
         )
-        sys.exit(1)
+    else:
+        print(f"\nSuccessfully created Parquet file: {output_parquet_name}")
 
 
 if __name__ == "__main__":
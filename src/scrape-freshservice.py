@@ -2,103 +2,380 @@
 """
 FreshService Ticket Scraper
 
-A robust, parallelized ticket scraper for FreshService with improved error
-handling, better date filtering, and configurable parallelization.
+A robust, concurrent ticket scraper for FreshService with improved error
+handling, better date filtering, and configurable concurrency.
+
+Each exported document holds:
+    ticket          the ticket, including its stats (fetched with include=stats)
+    conversations   all of the ticket's conversations
+    activities      all of the ticket's activities (new in export_version 2.0)
+    exported_at     local time the ticket was exported, in ISO format
+    export_version  "2.0"; exports from version 1.0 have no activities or stats
+
+Older and newer exports can be combined with
+combine_json_to_parquet_parallel_pyarrow.py, which widens its schema to the new
+fields; rows from 1.0 exports have null activities and stats.
 """
 
 import os
-import json
 import logging
 import calendar
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from datetime import datetime
-from typing import List, Optional, Dict, Any
+import asyncio
+import threading
+from typing import Iterator, List, Optional, Dict, Any, Tuple
 from pathlib import Path
-import time
 import random
-from freshpy.core import FreshPy
+import uuid
+from datetime import datetime
+import httpx
+import orjson
+import pyarrow as pa
+import pyarrow.dataset as ds
 import dotenv
 
 dotenv.load_dotenv()
 
+# Version of the exported document layout (see the module docstring)
+EXPORT_VERSION = "2.0"
+
+# Supported values of EXPORT_FORMAT
+EXPORT_FORMATS = ("json", "parquet")
+
+# Tickets collected from all partitions before they are written to the Parquet
+# dataset; each batch writes one file per day it contains
+PARQUET_BATCH_SIZE = int(os.getenv("PARQUET_BATCH_SIZE") or 5000)
+
+# Export directories already created during this run, keyed by export dir and date
+_DIR_CACHE: Dict[Tuple[Path, int, int, int], str] = {}
+_DIR_LOCK = threading.Lock()
+
 
 def create_directory_structure(
-    export_dir: str, year: int, month: int, day: int
-) -> Path:
-    """Create directory structure for exports."""
+    export_dir: Path, year: int, month: int, day: int
+) -> str:
+    """Create directory structure for exports and return its path as a string."""
+    key = (export_dir, year, month, day)
+    dir_str = _DIR_CACHE.get(key)
+    if dir_str is not None:
+        return dir_str
     month_name = calendar.month_name[month]
     dir_path = export_dir / str(year) / month_name / f"{day:02d}"
     if not dir_path.exists():
         logging.info(f"Creating directory: {dir_path}")
     dir_path.mkdir(parents=True, exist_ok=True)
-    return dir_path
+    dir_str = str(dir_path)
+    with _DIR_LOCK:
+        _DIR_CACHE[key] = dir_str
+    return dir_str
 
 
-def save_ticket(dir_path: Path, ticket: Dict[str, Any]) -> bool:
-    """Save ticket data to JSON file."""
+def save_ticket(dir_path: str, ticket: Dict[str, Any]) -> bool:
+    """Save ticket data to a compact JSON file."""
+    ticket_id = ticket["ticket"]["id"]
     try:
-        file_path = dir_path / f"{ticket["ticket"]["id"]}.json"
-        with open(file_path, "w", encoding="utf-8") as f:
-            json.dump(ticket, f, indent=2, ensure_ascii=False)
+        data = orjson.dumps(ticket, option=orjson.OPT_APPEND_NEWLINE)
+        # Plain string join; no Path object per ticket
+        file_path = f"{dir_path}/{ticket_id}.json"
+        with open(file_path, "wb") as f:
+            f.write(data)
         return True
     except Exception as e:
-        logging.error(f"Save failed for ticket {ticket["ticket"]["id"]}: {e}")
+        logging.error(f"Save failed for ticket {ticket_id}: {e}")
         return False
 
 
-def fetch_ticket(client: any, ticket_id: int) -> Optional[Dict[str, any]]:
-    """Fetch a single ticket by id"""
+def parse_updated_date(ticket: Dict[str, Any]) -> Tuple[int, int, int]:
+    """
+    Return the (year, month, day) of the ticket's updated_at timestamp, which
+    determines where it is exported. FreshService always formats timestamps as
+    YYYY-MM-DDTHH:MM:SSZ, so the fields are sliced out directly.
+    """
+    updated_at = ticket["ticket"]["updated_at"]
+    return int(updated_at[0:4]), int(updated_at[5:7]), int(updated_at[8:10])
+
+
+def write_parquet_batch(
+    export_dir: Path, run_id: str, batch_number: int, tickets: List[Dict[str, Any]]
+) -> None:
+    """
+    Append tickets to the Parquet dataset under export_dir, partitioned as
+    year=YYYY/month=MM/day=DD. The full response is stored in a 'data' struct
+    column (like the 'data' column written by the combine script, but without
+    its original_file_path/original_filename columns).
+    The struct type is inferred from this batch alone, so files written by
+    different batches can have different schemas (e.g. a custom field that is
+    null in one batch and a string in another); unify them when reading, for
+    example with pa.unify_schemas over the file schemas.
+    """
+    years, months, days = zip(*(parse_updated_date(ticket) for ticket in tickets))
+    # Zero-padded strings, so the directories are named month=MM/day=DD
+    table = pa.table(
+        {
+            "year": pa.array([f"{year:04d}" for year in years], type=pa.string()),
+            "month": pa.array([f"{month:02d}" for month in months], type=pa.string()),
+            "day": pa.array([f"{day:02d}" for day in days], type=pa.string()),
+            "data": pa.array(tickets),
+        }
+    )
+    ds.write_dataset(
+        table,
+        export_dir,
+        format="parquet",
+        partitioning=["year", "month", "day"],
+        partitioning_flavor="hive",
+        # Unique per run and batch so later runs into the same directory don't
+        # overwrite earlier files
+        basename_template=f"part-{run_id}-{batch_number}-{{i}}.parquet",
+        existing_data_behavior="overwrite_or_ignore",
+    )
+
+
+def export_parquet_batch(
+    export_dir: Path, run_id: str, batch_number: int, tickets: List[Dict[str, Any]]
+) -> None:
+    """
+    Write a batch with write_parquet_batch, falling back to one JSON file per
+    ticket if the batch can't be converted or written, so no ticket is lost.
+    """
+    try:
+        write_parquet_batch(export_dir, run_id, batch_number, tickets)
+        return
+    except Exception as e:
+        logging.error(
+            f"Parquet export failed for batch {batch_number} ({len(tickets)} tickets), "
+            f"saving them as JSON instead: {e}"
+        )
+    # Remove any files the failed write left behind so tickets aren't duplicated
+    for partial_file in export_dir.rglob(
+        f"part-{run_id}-{batch_number}-*.parquet"
+    ):
+        partial_file.unlink()
+    for ticket in tickets:
+        year, month, day = parse_updated_date(ticket)
+        dir_path = create_directory_structure(
+            export_dir, year=year, month=month, day=day
+        )
+        save_ticket(dir_path, ticket)
+
+
+def get_retry_after(response: httpx.Response) -> Optional[float]:
+    """Return the Retry-After delay in seconds from a rate-limited response, if any."""
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        # Missing, or an HTTP-date which we don't bother parsing
+        return None
+
+
+async def api_get(
+    client: httpx.AsyncClient, path: str, params: Optional[Dict[str, Any]] = None
+) -> Optional[httpx.Response]:
+    """GET an API path, retrying when rate limited. Returns None on failure."""
     retries = 5
     for i in range(retries):
         try:
-            response = client.tickets.get_ticket(
-                ticket_id, include=("stats"), conversations=True, activity=True
-            )
-            if isinstance(response, dict) and response.get("status_code") == 429:
-                delay = (5**i) + (random.random() * 5)
-                logging.warning(
-                    f"Rate limited on ticket {ticket_id}. Retrying in {delay:.2f}s"
-                )
-                time.sleep(delay)
-                continue
-            return response
-        except Exception as e:
-            logging.error(f"Error fetching ticket {ticket_id}: {e}")
+            response = await client.get(path, params=params)
+        except httpx.HTTPError as e:
+            logging.error(f"Error requesting {path}: {e}")
+            return None
+        if response.status_code == 429:
+            # Honour the server's Retry-After, else capped exponential backoff
+            delay = get_retry_after(response)
+            if delay is None:
+                delay = min(60, (2**i) + random.random())
+            logging.warning(f"Rate limited on {path}. Retrying in {delay:.2f}s")
+            await asyncio.sleep(delay)
+            continue
+        if response.status_code == 404:
+            logging.debug(f"Not found: {path}")
             return None
-    logging.error(f"Failed to fetch ticket {ticket_id} after {retries} retries.")
+        if response.is_error:
+            logging.error(f"Error requesting {path}: HTTP {response.status_code}")
+            return None
+        return response
+    logging.error(f"Failed to request {path} after {retries} retries.")
     return None
 
 
-def process_ticket(client: FreshPy, ticket_id: int, export_dir: Path) -> None:
-    """Fetch, process, and save a single ticket."""
+async def get_all_pages(
+    client: httpx.AsyncClient, path: str, key: str
+) -> Optional[list]:
+    """
+    Collect the `key` list from every page of a paginated API path.
+    Returns None if any page fails, rather than a silently truncated list.
+    """
+    items = []
+    params = {"per_page": 100}
+    while path:
+        response = await api_get(client, path, params=params)
+        if response is None:
+            return None
+        items.extend(response.json().get(key, []))
+        # Follow the Link header; the next URL already carries the query string
+        path = response.links.get("next", {}).get("url")
+        params = None
+    return items
+
+
+async def fetch_ticket(
+    client: httpx.AsyncClient, ticket_id: int
+) -> Optional[Dict[str, Any]]:
+    """
+    Fetch a single ticket by id, along with its conversations and activities.
+    Returns None unless the ticket and all of its sub-resources were fetched.
+    """
+    response = await api_get(
+        client, f"tickets/{ticket_id}", params={"include": "stats"}
+    )
+    if response is None:
+        return None
+    ticket = response.json()
+    conversations, activities = await asyncio.gather(
+        get_all_pages(client, f"tickets/{ticket_id}/conversations", "conversations"),
+        get_all_pages(client, f"tickets/{ticket_id}/activities", "activities"),
+    )
+    if conversations is None or activities is None:
+        logging.error(
+            f"Skipping ticket {ticket_id}: failed to fetch its conversations or activities."
+        )
+        return None
+    ticket["conversations"] = conversations
+    ticket["activities"] = activities
+    ticket["exported_at"] = datetime.now().isoformat()
+    ticket["export_version"] = EXPORT_VERSION
+    return ticket
+
+
+async def process_ticket(
+    client: httpx.AsyncClient,
+    ticket_id: int,
+    export_dir: Path,
+    parquet_queue: Optional[asyncio.Queue] = None,
+) -> None:
+    """
+    Fetch, process, and save a single ticket. When a queue is given the
+    ticket is handed to the Parquet writer instead of saved as JSON.
+    """
     logging.debug(f"Processing ticket {ticket_id}")
-    response = fetch_ticket(client, ticket_id)
+    response = await fetch_ticket(client, ticket_id)
     logging.debug(f"{response}")
     if response and response.get("ticket", None):
-        updated_at_str = response["ticket"]["updated_at"].replace("Z", "+00:00")
-        updated_at = datetime.fromisoformat(updated_at_str)
-        dir_path = create_directory_structure(
-            export_dir,
-            year=updated_at.year,
-            month=updated_at.month,
-            day=updated_at.day,
-        )
-        save_ticket(dir_path, response)
+        if parquet_queue is not None:
+            parquet_queue.put_nowait(response)
+            return
+        year, month, day = parse_updated_date(response)
+        # Most tickets land in a directory that already exists, so check the
+        # cache here and only hand off to a thread when mkdir is needed
+        dir_path = _DIR_CACHE.get((export_dir, year, month, day))
+        if dir_path is None:
+            dir_path = await asyncio.to_thread(
+                create_directory_structure, export_dir, year=year, month=month, day=day
+            )
+        await asyncio.to_thread(save_ticket, dir_path, response)
 
 
-def process_partition(
+async def process_partition(
     partition_id: int,
-    ticket_ids: List[int],
+    client: httpx.AsyncClient,
+    ticket_ids: Iterator[int],
+    export_dir: Path,
+    parquet_queue: Optional[asyncio.Queue] = None,
+) -> None:
+    """Process ticket IDs from the shared iterator until it is exhausted."""
+    logging.debug("Partition %s starting", partition_id)
+    # All partitions pull from the same iterator, so each one picks up the next
+    # ticket as soon as it is free and at most one request per partition is in flight
+    for tid in ticket_ids:
+        # One bad ticket must not end this partition and shrink concurrency for
+        # the rest of the run
+        try:
+            await process_ticket(client, tid, export_dir, parquet_queue)
+        except Exception as e:
+            logging.error(f"Error processing ticket {tid}: {e}", exc_info=True)
+    logging.debug("Partition %s finished", partition_id)
+
+
+async def export_parquet(
+    parquet_queue: asyncio.Queue, export_dir: Path, run_id: str
+) -> None:
+    """
+    Collect tickets from all partitions into batches of PARQUET_BATCH_SIZE and
+    export each one until None is received. A single writer keeps batches, and
+    so the files written per day, as large as possible.
+    `run_id` makes the names of the files written by this run unique.
+    """
+    batch_number = 0
+    batch = []
+    while True:
+        ticket = await parquet_queue.get()
+        if ticket is not None:
+            batch.append(ticket)
+        if batch and (ticket is None or len(batch) >= PARQUET_BATCH_SIZE):
+            await asyncio.to_thread(
+                export_parquet_batch, export_dir, run_id, batch_number, batch
+            )
+            batch_number += 1
+            batch = []
+        if ticket is None:
+            return
+
+
+async def scrape(
     domain: str,
     api_key: str,
+    ticket_ids: range,
     export_dir: Path,
+    number_partitions: int,
+    export_format: str = "json",
 ) -> None:
-    """Process a partition of ticket IDs."""
-    logging.info("Partition %s starting", partition_id)
-    client = FreshPy(domain=domain, api_key=api_key)
-    # Using map for functional style, even with side effects
-    list(map(lambda tid: process_ticket(client, tid, export_dir), ticket_ids))
-    logging.info("Partition %s finished", partition_id)
+    """
+    Scrape all ticket IDs using `number_partitions` concurrent partitions,
+    exporting each ticket as a JSON file or into a Parquet dataset.
+    """
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(
+            f"Unknown export format {export_format!r}; expected one of {EXPORT_FORMATS}"
+        )
+    if not domain.startswith(("http://", "https://")):
+        domain = f"https://{domain}"
+    limits = httpx.Limits(
+        max_connections=number_partitions, max_keepalive_connections=number_partitions
+    )
+    async with httpx.AsyncClient(
+        base_url=f"{domain.rstrip('/')}/api/v2/",
+        auth=(api_key, "X"),
+        http2=True,
+        limits=limits,
+        timeout=30,
+    ) as client:
+        shared_ticket_ids = iter(ticket_ids)
+        parquet_queue = None
+        if export_format == "parquet":
+            parquet_queue = asyncio.Queue()
+            writer = asyncio.create_task(
+                export_parquet(parquet_queue, export_dir, uuid.uuid4().hex)
+            )
+        results = await asyncio.gather(
+            *(
+                process_partition(
+                    i, client, shared_ticket_ids, export_dir, parquet_queue
+                )
+                for i in range(number_partitions)
+            ),
+            return_exceptions=True,
+        )
+        if parquet_queue is not None:
+            # Flush the last batch
+            parquet_queue.put_nowait(None)
+            await writer
+    for i, result in enumerate(results):
+        if isinstance(result, Exception):
+            logging.error(
+                "An error occurred in partition %s: %s",
+                i,
+                result,
+                exc_info=result,
+            )
 
 
 def main():
@@ -109,64 +386,51 @@ def main():
     )
     api_key = os.getenv("FRESH_SERVICE_API_KEY")
     domain = os.getenv("FRESH_SERVICE_DOMAIN")
+    # 'json' (one file per ticket) or 'parquet' (hive-partitioned dataset)
+    export_format = os.getenv("EXPORT_FORMAT", "json").lower()
+    if export_format not in EXPORT_FORMATS:
+        logging.error(
+            "Unknown EXPORT_FORMAT %r; expected one of %s.", export_format, EXPORT_FORMATS
+        )
+        return
     # setup export dir
     export_dir = Path(os.getenv("EXPORT_DIR")).resolve()
     export_dir.mkdir(parents=True, exist_ok=True)
     logging.info("Export directory created at: %s", export_dir)
-    # split requests into partitions
+    # ticket IDs are shared between concurrent partitions
     start_ticket_id = int(os.getenv("START_TICKET_ID"))
     end_ticket_id = int(os.getenv("END_TICKET_ID"))
-    number_partitions = int(os.getenv("NUMBER_PARTITIONS"))
-    all_ticket_ids = list(range(start_ticket_id, end_ticket_id + 1))
+    number_partitions = int(os.getenv("NUMBER_PARTITIONS", 128))
+    all_ticket_ids = range(start_ticket_id, end_ticket_id + 1)
     if not all_ticket_ids:
         logging.warning("No ticket IDs to process.")
         return
-    partition_size = len(all_ticket_ids) // number_partitions
-    if partition_size == 0:
-        partition_size = 1
-    partitions = [
-        all_ticket_ids[i : i + partition_size]
-        for i in range(0, len(all_ticket_ids), partition_size)
-    ]
     logging.debug("Scraping tickets from %s to %s", start_ticket_id, end_ticket_id)
-    logging.debug("Created %d partitions of size %d", len(partitions), partition_size)
     logging.debug("Using %s partitions", number_partitions)
-    logging.debug("Exporting to %s", export_dir)
-    # start parallel requests for each partition using worker pool
-    with ThreadPoolExecutor(max_workers=number_partitions) as executor:
-        futures = {
-            executor.submit(
-                process_partition,
-                i,
-                partition,
-                domain,
-                api_key,
-                export_dir,
-            ): partition
-            for i, partition in enumerate(partitions)
-        }
-        for future in as_completed(futures):
-            partition = futures[future]
-            try:
-                future.result()
-                logging.debug(
-                    "Partition for tickets %s-%s completed successfully.",
-                    partition[0],
-                    partition[-1],
-                )
-            except Exception as e:
-                logging.error(
-                    "An error occurred in partition for tickets %s-%s: %s",
-                    partition[0],
-                    partition[-1],
-                    e,
-                    exc_info=True,
-                )
+    logging.debug("Exporting %s to %s", export_format, export_dir)
+    asyncio.run(
+        scrape(
+            domain,
+            api_key,
+            all_ticket_ids,
+            export_dir,
+            number_partitions,
+            export_format,
+        )
+    )
 
     logging.info("Scraping finished. Verifying created files...")
-    exported_files = list(export_dir.rglob("*.json"))
-    if exported_files:
-        logging.info("Successfully exported %d tickets.", len(exported_files))
+    if export_format == "parquet":
+        exported_files = [str(f) for f in export_dir.rglob("*.parquet")]
+        exported_tickets = (
+            ds.dataset(exported_files).count_rows() if exported_files else 0
+        )
+        # Batches that couldn't be written as Parquet fall back to JSON files
+        exported_tickets += sum(1 for _ in export_dir.rglob("*.json"))
+    else:
+        exported_tickets = sum(1 for _ in export_dir.rglob("*.json"))
+    if exported_tickets:
+        logging.info("Successfully exported %d tickets.", exported_tickets)
     else:
         logging.error("No files were exported. Please check the logs for errors.")
 